@@ -32,7 +32,7 @@ setup(
     },
     include_package_data = True,
     zip_safe = False,
-    install_requires = ['Trac'],
+    install_requires = ['Trac >= 1.0'],
     entry_points = """
         [trac.plugins]
         trackanbanboard = trackanbanboard
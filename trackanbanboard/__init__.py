@@ -1 +1,2 @@
 from kanbanboardmacro import *
+from admin import *
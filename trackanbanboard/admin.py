@@ -0,0 +1,247 @@
+import json
+import sys
+
+from trac.admin.api import IAdminCommandProvider, AdminCommandError, get_dir_list
+from trac.core import Component, implements
+from trac.ticket.api import TicketSystem
+from trac.util.text import printout, printerr
+from trac.wiki.model import WikiPage
+
+from kanbanboardmacro import KanbanBoard, KanbanBoardMacro, KanbanCard, \
+    InvalidDataError, InvalidFieldError
+
+
+class KanbanBoardAdmin(Component):
+    """trac-admin commands for exporting and importing Kanban boards.
+
+    Boards are stored one per line as JSON objects with "name" (wiki page name), "columns",
+    "fields" and "cards" properties. "cards" is a snapshot of id, summary and status of the
+    tickets on the board. It is ignored on import, where board columns are fixed to match the
+    current state of tickets in the environment.
+    """
+
+    implements(IAdminCommandProvider)
+
+    # Maximum number of ticket IDs in single database query
+    query_batch_size = 500
+
+    # IAdminCommandProvider methods
+
+    def get_admin_commands(self):
+        yield ('kanban export', '<file> [page] [...]',
+               """Export Kanban boards to file
+
+               Exports all boards, or boards on the given wiki pages, to <file>
+               as newline-delimited JSON. Use "-" to write to stdout.""",
+               self._complete_file, self._do_export)
+        yield ('kanban import', '<file>',
+               """Import Kanban boards from file
+
+               Reads boards exported with "kanban export" and saves them to
+               their wiki pages. New pages are created for missing boards.
+               Nothing is saved if any board is invalid. Use "-" to read
+               from stdin.""",
+               self._complete_file, self._do_import)
+        yield ('kanban verify', '<file>',
+               """Verify Kanban boards in file
+
+               Checks that boards in <file> can be imported to this
+               environment and reports tickets that would be removed from
+               the boards. Use "-" to read from stdin.""",
+               self._complete_file, self._do_verify)
+
+    def _complete_file(self, args):
+        if len(args) == 1:
+            return get_dir_list(args[-1])
+
+    def _do_export(self, filename, *pages):
+        ticket_fields = TicketSystem(self.env).get_ticket_fields()
+        found = set()
+        out = sys.stdout if filename == '-' else open(filename, 'w')
+        try:
+            for name, text in self._get_board_pages(pages):
+                found.add(name)
+                if not KanbanBoardMacro.board_id_regexp.match(name):
+                    printerr('Skipping board "%s": Invalid board name' % name)
+                    continue
+                try:
+                    board = KanbanBoard(name, ticket_fields, self.env, self.log,
+                                        KanbanBoard.parse_wiki_text(text))
+                except (InvalidDataError, InvalidFieldError) as e:
+                    printerr('Skipping board "%s": %s' % (name, self._get_error_message(e)))
+                    continue
+
+                cards = self._fetch_cards(board.get_ticket_ids())
+                board_data = {
+                    'name': board.name,
+                    'columns': board.columns,
+                    'fields': board.fields,
+                    'cards': [cards[str(id)].to_json_data() for id in board.get_ticket_ids()
+                              if str(id) in cards]
+                }
+                out.write(json.dumps(board_data, sort_keys=True) + '\n')
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+        for name in pages:
+            if name not in found:
+                printerr('Skipping page "%s": No KanbanBoard data found' % name)
+
+    def _do_import(self, filename):
+        boards = self._load_boards(filename)
+
+        saved = 0
+        with self.env.db_transaction:
+            for board in boards:
+                if self._save_board(board):
+                    saved += 1
+        printout('%d boards imported, %d unchanged' % (saved, len(boards) - saved))
+
+    def _do_verify(self, filename):
+        boards = self._load_boards(filename)
+        printout('%d boards are valid' % len(boards))
+
+    def _load_boards(self, filename):
+        """Read and validate all boards in file. Ticket states for all boards are fetched with
+           batched queries and board columns are fixed to match them.
+           Raises AdminCommandError if any of the boards is invalid.
+        """
+        ticket_fields = TicketSystem(self.env).get_ticket_fields()
+        boards = []
+        errors = []
+        names = {}
+        f = sys.stdin if filename == '-' else open(filename)
+        try:
+            for lineno, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    board = self._parse_board(json.loads(line), ticket_fields)
+                    if board.name in names:
+                        errors.append('Line %d: Board "%s" is already defined on line %d'
+                                      % (lineno, board.name, names[board.name]))
+                        continue
+                    names[board.name] = lineno
+                    boards.append(board)
+                except ValueError:
+                    errors.append('Line %d: Invalid JSON data' % lineno)
+                except (InvalidDataError, InvalidFieldError) as e:
+                    errors.append('Line %d: %s' % (lineno, self._get_error_message(e)))
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+        if errors:
+            raise AdminCommandError('\n'.join(errors))
+
+        ids = set()
+        for board in boards:
+            ids.update(board.get_ticket_ids())
+        cards = self._fetch_cards(ids)
+
+        for board in boards:
+            board.tickets = cards
+            count = len(board.get_ticket_ids())
+            board.fix_ticket_columns(None, False, False)
+            removed = count - len(board.get_ticket_ids())
+            if removed:
+                printout('Board "%s": %d invalid or unmapped tickets will be removed'
+                         % (board.name, removed))
+
+        return boards
+
+    def _parse_board(self, data, ticket_fields):
+        if not isinstance(data, dict):
+            raise InvalidDataError('Board data must be an object')
+
+        name = data.get('name')
+        if not isinstance(name, basestring) or not KanbanBoardMacro.board_id_regexp.match(name):
+            raise InvalidDataError('Invalid board name "%s"' % name)
+
+        columns = data.get('columns')
+        if not isinstance(columns, list):
+            raise InvalidDataError('Board "%s": No columns defined' % name)
+
+        valid_states = KanbanBoard.get_valid_states(ticket_fields)
+
+        column_ids = []
+        ticket_ids = set()
+        for col in columns:
+            try:
+                KanbanBoard.validate_column(col, valid_states)
+            except InvalidDataError as e:
+                raise InvalidDataError('Board "%s": %s' % (name, e.msg))
+            if col['id'] in column_ids:
+                raise InvalidDataError('Board "%s": Duplicate column %d' % (name, col['id']))
+            column_ids.append(col['id'])
+
+            for tid in col.setdefault('tickets', []):
+                if not isinstance(tid, (int, long)) or isinstance(tid, bool) or tid <= 0:
+                    raise InvalidDataError('Board "%s": Invalid ticket ID "%s"' % (name, tid))
+                if tid in ticket_ids:
+                    raise InvalidDataError('Board "%s": Duplicate ticket %d' % (name, tid))
+                ticket_ids.add(tid)
+
+        fields = data.get('fields', [])
+        if not isinstance(fields, list) or \
+                not all(isinstance(field_name, basestring) for field_name in fields):
+            raise InvalidDataError('Board "%s": Fields must be a list of strings' % name)
+
+        # Existing page must have a KanbanBoard block that can be replaced on import
+        page = WikiPage(self.env, name)
+        if page.exists and KanbanBoard.replace_wiki_text(page.text, '') is None:
+            raise InvalidDataError('Board "%s": Wiki page has no KanbanBoard data' % name)
+
+        board_data = { 'columns': columns }
+        if fields:
+            board_data['fields'] = fields
+        return KanbanBoard(name, ticket_fields, self.env, self.log, board_data)
+
+    def _save_board(self, board):
+        """Save board to its wiki page. Returns True if the page was modified."""
+        data = board.get_json(False, True)
+        page = WikiPage(self.env, board.name)
+        if page.exists:
+            text = KanbanBoard.replace_wiki_text(page.text, data)
+            if text is None:
+                raise AdminCommandError('Wiki page "%s" has no KanbanBoard data' % board.name)
+            if text == page.text:
+                return False
+        else:
+            text = '{{{\n#!KanbanBoard\n%s\n}}}\n' % data
+
+        page.text = text
+        page.save('trac', 'Kanban board imported', '127.0.0.1')
+        return True
+
+    def _get_board_pages(self, names):
+        """Return (name, text) of latest version of wiki pages containing KanbanBoard data."""
+        rows = self.env.db_query("""
+                SELECT w.name, w.text FROM wiki w
+                INNER JOIN (SELECT name, max(version) AS version
+                            FROM wiki GROUP BY name) w2
+                ON w.name = w2.name AND w.version = w2.version
+                WHERE w.text LIKE %s ORDER BY w.name
+                """, ('%#!KanbanBoard%',))
+        for name, text in rows:
+            if not names or name in names:
+                yield name, text
+
+    def _fetch_cards(self, ids):
+        """Return minimal cards of tickets given in "ids" fetched with batched queries."""
+        cards = {}
+        ids = list(ids)
+        for i in xrange(0, len(ids), self.query_batch_size):
+            batch = ids[i:i + self.query_batch_size]
+            for id, summary, status in self.env.db_query("""
+                    SELECT id, summary, status FROM ticket WHERE id IN (%s)
+                    """ % ','.join(['%s'] * len(batch)), batch):
+                cards[str(id)] = KanbanCard(id, summary, status)
+        return cards
+
+    def _get_error_message(self, e):
+        if isinstance(e, InvalidFieldError):
+            return 'Invalid ticket fields: %s' % ', '.join(e.fields)
+        return e.msg
@@ -1,4 +1,3 @@
-import copy
 import json
 import os.path
 import re
@@ -33,6 +32,60 @@ class InvalidFieldError(KanbanError):
         self.fields = fields
 
 
+class InvalidRequestError(KanbanError):
+    """Raised when HTTP request arguments or data are not valid."""
+    def __init__(self, msg):
+        self.msg = msg
+
+
+# Shared table of interned ticket field values. Fields like status, owner and priority have
+# only a handful of distinct values, so all cards on all boards share the same string objects.
+_interned_values = {}
+
+def intern_value(value):
+    """Return canonical instance of value (if it is a string) from the shared intern table."""
+    if isinstance(value, basestring):
+        return _interned_values.setdefault(value, value)
+    return value
+
+
+class KanbanCard(object):
+    """Compact representation of a ticket on the board.
+
+       Extra fields are stored as tuple of (name, value) pairs and changelog as tuple of
+       (time, author, ((field, old value, new value), ...)) tuples. Both are None for tickets
+       which were fetched without details.
+    """
+    __slots__ = ('id', 'summary', 'status', 'fields', 'changelog')
+
+    def __init__(self, id, summary, status, fields=None, changelog=None):
+        self.id = id
+        self.summary = summary
+        self.status = intern_value(status)
+        self.fields = fields
+        self.changelog = changelog
+
+    def to_json_data(self):
+        """Return card as dictionary in the format used by board JSON."""
+        data = { 'id': self.id, 'summary': self.summary, 'status': self.status }
+        if self.fields is not None:
+            for field_name, value in self.fields:
+                data[field_name] = value
+        if self.changelog is not None:
+            data['changelog'] = [
+                {
+                    'time': time,
+                    'author': author,
+                    'changes': [
+                        { 'field': field, 'oldValue': old, 'newValue': new }
+                        for field, old, new in changes
+                    ]
+                }
+                for time, author, changes in self.changelog
+            ]
+        return data
+
+
 class KanbanBoard:
     data_start_regexp = re.compile('\s*({{{)?#!KanbanBoard')
     data_end_regexp = re.compile('\s*}}}')
@@ -43,7 +96,15 @@ class KanbanBoard:
     # These ticket fields are shown in detail dialog regardless of user's field definitions
     always_shown_fields = ['summary', 'description', 'time', 'changetime']
 
-    def __init__(self, name, detailed_tickets, ticket_fields, env, logger):
+    # Values of these ticket fields (and all fields with options) are interned
+    interned_fields = ['owner', 'reporter', 'type', 'priority', 'severity', 'milestone',
+                       'component', 'version', 'resolution']
+
+    # Valid column properties
+    column_keys = ['id', 'name', 'states', 'tickets', 'wip']
+
+    def __init__(self, name, ticket_fields, env, logger, data=None):
+        """Create board from data on wiki page "name", or from "data" if given."""
         self.name = name
         self.env = env
         self.log = logger
@@ -51,7 +112,14 @@ class KanbanBoard:
         # List of valid ticket fields and options as returned by TicketSystem.get_ticket_fields()
         self.ticket_fields = ticket_fields
 
-        data = self.load_wiki_data(self.name)
+        # Names of ticket fields whose values are shared through the intern table
+        self.interned_field_names = set(self.interned_fields)
+        for field in self.ticket_fields:
+            if 'options' in field:
+                self.interned_field_names.add(field['name'])
+
+        if data is None:
+            data = self.load_wiki_data(self.name)
         if 'fields' in data:
             invalid_fields = self.get_invalid_fields(data['fields'], self.ticket_fields)
             if invalid_fields:
@@ -72,6 +140,11 @@ class KanbanBoard:
         self.status_map = self.get_status_to_column_map(self.columns)
 
         self.tickets = {}
+
+    def load_tickets(self, detailed_tickets):
+        """Fetch all tickets currently on the board. Full data is fetched for tickets given in
+           "detailed_tickets", minimal data for others.
+        """
         self.fetch_tickets(self.tickets, self.get_ticket_ids(), detailed_tickets)
 
     def add_tickets(self, ids):
@@ -89,16 +162,15 @@ class KanbanBoard:
                 self.log.error('Ticket %d is already on the board' % id)
                 continue
 
-            t = { 'id': id }
             try:
                 ticket = model.Ticket(self.env, id)
             except:
                 self.log.error('Failed to fetch ticket %d' % id)
                 continue
 
-            t['summary'] = ticket.get_value_or_default('summary')
-            t['status'] = ticket.get_value_or_default('status')
-            self.tickets[str(id)] = t
+            self.tickets[str(id)] = KanbanCard(id,
+                ticket.get_value_or_default('summary'),
+                ticket.get_value_or_default('status'))
             valid_ids.append(id)
 
         self.columns[0]['tickets'].extend(valid_ids)
@@ -139,17 +211,36 @@ class KanbanBoard:
             self.log.error('Wiki page "%s" doesn\'t exist' % page_name)
             raise InvalidDataError('Wiki page doesn\'t exist')
 
-        lines = page.text.split('\n')
+        return self.parse_wiki_text(page.text)
+
+    def save_wiki_data(self, req):
+        page = WikiPage(self.env, self.name)
+        if not page.exists:
+            self.log.error('Wiki page "%s" doesn\'t exist' % self.name)
+            return None
+
+        new_text = self.replace_wiki_text(page.text, self.get_json(False, True))
+        if new_text is not None:
+            page.text = new_text
+            try:
+                page.save(req.authname, 'Kanban board data changed', req.remote_addr)
+            except TracError as e:
+                self.log.error('TracError: "%s"' % e.message)
+
+    @classmethod
+    def parse_wiki_text(cls, text):
+        """Return board data parsed from KanbanBoard processor block in wiki text."""
+        lines = text.split('\n')
         first = -1
         last = -1
         data_lines = []
 
         for index, line in enumerate(lines):
             if first < 0:
-                if self.data_start_regexp.match(line):
+                if cls.data_start_regexp.match(line):
                     first = index + 1
             else:
-                if self.data_end_regexp.match(line):
+                if cls.data_end_regexp.match(line):
                     last = index - 1
                 elif last < 0:
                     data_lines.append(line)
@@ -168,13 +259,12 @@ class KanbanBoard:
 
         raise InvalidDataError('Last line of data not found')
 
-    def save_wiki_data(self, req):
-        page = WikiPage(self.env, self.name)
-        if not page.exists:
-            self.log.error('Wiki page "%s" doesn\'t exist' % self.name)
-            return None
-
-        lines = page.text.split('\n')
+    @classmethod
+    def replace_wiki_text(cls, text, data):
+        """Return wiki text where content of KanbanBoard processor block is replaced with "data".
+           Returns None if the block is not found.
+        """
+        lines = text.split('\n')
         first = -1
         last = -1
         new_lines = []
@@ -182,22 +272,62 @@ class KanbanBoard:
         for index, line in enumerate(lines):
             if first < 0:
                 new_lines.append(line)
-                if self.data_start_regexp.match(line):
+                if cls.data_start_regexp.match(line):
                     first = index + 1
-                    new_lines.append(self.get_json(False, True))
+                    new_lines.append(data)
             elif last < 0:
-                if self.data_end_regexp.match(line):
+                if cls.data_end_regexp.match(line):
                     last = index - 1
                     new_lines.append(line)
             else:
                 new_lines.append(line)
 
         if last > 0:
-            page.text = '\n'.join(new_lines)
-            try:
-                page.save(req.authname, 'Kanban board data changed', req.remote_addr)
-            except TracError as e:
-                self.log.error('TracError: "%s"' % e.message)
+            return '\n'.join(new_lines)
+        return None
+
+    @classmethod
+    def get_valid_states(cls, ticket_fields):
+        """Return valid ticket states from ticket field definitions."""
+        for field in ticket_fields:
+            if field['name'] == 'status':
+                return field.get('options', [])
+        return []
+
+    @classmethod
+    def validate_column(cls, col, valid_states, complete=True):
+        """Check names and types of column properties. If "complete" is False, column may
+           contain only some of the properties (as in board update requests). Contents of
+           'tickets' list are not checked. Raises InvalidDataError if column is not valid.
+        """
+        if not isinstance(col, dict) or 'id' not in col:
+            raise InvalidDataError('Column must be an object with an ID')
+        if not isinstance(col['id'], (int, long)) or isinstance(col['id'], bool):
+            raise InvalidDataError('Invalid column ID "%s"' % col['id'])
+
+        invalid_keys = [key for key in col if key not in cls.column_keys]
+        if invalid_keys:
+            raise InvalidDataError('Invalid column properties: %s' % ', '.join(invalid_keys))
+        if complete:
+            missing_keys = [key for key in ('name', 'states') if key not in col]
+            if missing_keys:
+                raise InvalidDataError('Column %d is missing properties: %s'
+                                       % (col['id'], ', '.join(missing_keys)))
+
+        if 'name' in col and not isinstance(col['name'], basestring):
+            raise InvalidDataError('Column name must be a string')
+        if 'wip' in col and (not isinstance(col['wip'], (int, long)) or isinstance(col['wip'], bool)):
+            raise InvalidDataError('Column WIP limit must be an integer')
+        if 'states' in col:
+            states = col['states']
+            if not isinstance(states, list) or not states or \
+                    not all(isinstance(state, basestring) for state in states):
+                raise InvalidDataError('Column states must be a non-empty list of strings')
+            invalid_states = [state for state in states if state not in valid_states]
+            if invalid_states:
+                raise InvalidDataError('Invalid column states: %s' % ', '.join(invalid_states))
+        if 'tickets' in col and not isinstance(col['tickets'], list):
+            raise InvalidDataError('Column tickets must be a list')
 
     def get_status_to_column_map(self, columns):
         map = {}
@@ -212,60 +342,51 @@ class KanbanBoard:
 
     def fetch_tickets(self, tickets, ids, detailed):
         for id in ids:
-            t = { 'id': id }
             try:
                 ticket = model.Ticket(self.env, id)
             except:
                 self.log.error('Failed to fetch ticket %d' % id)
-                if str(id) in tickets:
-                    delattr(tickets, str(id))
+                tickets.pop(str(id), None)
                 continue
 
-            # Get mandatory fields
-            for field_name in self.mandatory_fields:
-                t[field_name] = ticket.get_value_or_default(field_name)
+            card = KanbanCard(id,
+                ticket.get_value_or_default('summary'),
+                ticket.get_value_or_default('status'))
 
             if id in detailed:
-                # Get fields that are are always shown in detail dialog
-                for field_name in self.always_shown_fields:
-                    if field_name not in t:
-                        t[field_name] = ticket.get_value_or_default(field_name)
-
-                # Get user specified extra fields
-                for field_name in self.fields:
-                    if field_name not in self.mandatory_fields:
-                        t[field_name] = ticket.get_value_or_default(field_name)
-
-                # Convert DateTimes to (millisecond) timestamps
-                if 'time' in t:
-                    t['time'] = to_timestamp(t['time']) * 1000
-                if 'changetime' in t:
-                    t['changetime'] = to_timestamp(t['changetime']) * 1000
+                fields = []
+
+                # Get fields that are are always shown in detail dialog and
+                # user specified extra fields
+                for field_name in self.always_shown_fields + self.fields:
+                    if field_name in self.mandatory_fields:
+                        continue
+                    value = ticket.get_value_or_default(field_name)
+                    if field_name in ('time', 'changetime'):
+                        # Convert DateTimes to (millisecond) timestamps
+                        value = to_timestamp(value) * 1000
+                    elif field_name in self.interned_field_names:
+                        value = intern_value(value)
+                    fields.append((intern_value(field_name), value))
+                card.fields = tuple(fields)
 
                 # Get changes and comments and group changes from same action together
-                t['changelog'] = []
-                changelog = ticket.get_changelog()
+                changelog = []
                 time_entry = None
-                for log_item in changelog:
+                for log_item in ticket.get_changelog():
                     current_time = to_timestamp(log_item[0]) * 1000
-                    if time_entry is None or time_entry['time'] < current_time:
+                    if time_entry is None or time_entry[0] < current_time:
                         if time_entry is not None:
-                            t['changelog'].append(time_entry)
-                        time_entry = {}
-                        time_entry['time'] = current_time
-                        time_entry['author'] = log_item[1]
-                        time_entry['changes'] = []
-
-                    change_entry = {}
-                    change_entry['field'] = log_item[2]
-                    change_entry['oldValue'] = log_item[3]
-                    change_entry['newValue'] = log_item[4]
-                    time_entry['changes'].append(change_entry)
+                            changelog.append((time_entry[0], time_entry[1], tuple(time_entry[2])))
+                        time_entry = (current_time, intern_value(log_item[1]), [])
+
+                    time_entry[2].append((intern_value(log_item[2]), log_item[3], log_item[4]))
 
                 if time_entry is not None:
-                    t['changelog'].append(time_entry)
+                    changelog.append((time_entry[0], time_entry[1], tuple(time_entry[2])))
+                card.changelog = tuple(changelog)
 
-            tickets[str(id)] = t
+            tickets[str(id)] = card
 
     def get_json(self, include_tickets, include_fields):
         """Return JSON representation of the board.
@@ -280,11 +401,12 @@ class KanbanBoard:
         if include_tickets:
             jason['columns'] = []
             for col in self.columns:
-                colcopy = copy.deepcopy(col)
+                # Shallow copy is enough as only 'tickets' list is replaced
+                colcopy = dict(col)
                 colcopy['tickets'] = []
                 for t in col['tickets']:
                     try:
-                        colcopy['tickets'].append(self.tickets[str(t)])
+                        colcopy['tickets'].append(self.tickets[str(t)].to_json_data())
                     except KeyError:
                         pass
                 jason['columns'].append(colcopy)
@@ -373,10 +495,10 @@ class KanbanBoard:
             for tid in col['tickets']:
                 if (str(tid) in self.tickets):
                     ticket = self.tickets[str(tid)]
-                    if not ticket['status'] in self.status_map:
+                    if not ticket.status in self.status_map:
                         # board doesn't have suitable column for this ticket
                         continue
-                    target_cols = self.status_map[ticket['status']]
+                    target_cols = self.status_map[ticket.status]
                     if not col['id'] in target_cols:
                         # ticket is in wrong column
                         if tid not in old_lists[str(target_cols[0])]:
@@ -448,7 +570,24 @@ class KanbanBoardMacro(WikiMacroBase):
 
     implements(ITemplateProvider, IRequestHandler)
 
-    request_regexp = re.compile('\/kanbanboard\/((?P<bid>\w+\s*\w*)(?P<ticket>\/ticket)?)?')
+    request_regexp = re.compile('\/kanbanboard\/((?P<bid>[^\/]+)(?P<ticket>\/ticket)?)?\Z')
+    board_id_regexp = re.compile('\w+\Z')
+    ticket_id_regexp = re.compile('[0-9]+\Z')
+
+    # Ticket fields that can not be modified with POST request
+    read_only_fields = ['time', 'changetime']
+
+    # Maximum number of ticket IDs in ?detailed=, ?add= and ?remove= arguments
+    max_id_list_length = 100
+
+    # Maximum size of POST request body in bytes
+    max_request_size = 512 * 1024
+
+    # Maximum number of tickets in all columns of single POST request
+    max_ticket_list_length = 1000
+
+    # Maximum number of tickets that can be modified with single POST request
+    max_ticket_saves = 50
 
     ticket_fields = []
 
@@ -500,6 +639,9 @@ class KanbanBoardMacro(WikiMacroBase):
     #
     # ?remove=1,2
     #      Before handling request, removes tickets #1 and #2 from the board.
+    #
+    # Invalid board IDs, ticket IDs, ticket fields and column data are rejected with
+    # 400 Bad Request and JSON error object { "error": "<message>" }.
 
     def process_request(self, req):
         self.log.debug('HTTP request: %s, method: %s, user: %s' % (req.path_info, req.method, req.authname))
@@ -522,19 +664,47 @@ class KanbanBoardMacro(WikiMacroBase):
             meta_data['ticketFields'] = self.ticket_fields
             return req.send(json.dumps(meta_data), content_type='application/json')
 
-        arg_list = parse_arg_list(req.query_string)
+        # Validate everything before loading the board so that bad requests cause no extra work
         detailed_tickets = []
         added_tickets = []
         removed_tickets= []
-        for arg in arg_list:
-            if arg[0] == 'detailed':
-                detailed_tickets = self._parse_id_list(arg[1])
-            elif arg[0] == 'add':
-                added_tickets = self._parse_id_list(arg[1])
-            elif arg[0] == 'remove':
-                removed_tickets = self._parse_id_list(arg[1])
+        request_data = None
+        try:
+            if not self.board_id_regexp.match(board_id):
+                raise InvalidRequestError('Invalid board ID "%s"' % board_id)
+
+            arg_list = parse_arg_list(req.query_string)
+            for arg in arg_list:
+                if arg[0] == 'detailed':
+                    detailed_tickets = self._parse_id_list(arg[1])
+                elif arg[0] == 'add':
+                    added_tickets = self._parse_id_list(arg[1])
+                elif arg[0] == 'remove':
+                    removed_tickets = self._parse_id_list(arg[1])
+
+            if req.method == 'POST':
+                request_data = self._read_json(req)
+                if is_ticket_call:
+                    self._validate_ticket_data(request_data)
+                else:
+                    self._validate_column_data(request_data)
+        except InvalidRequestError as e:
+            return self._send_error(req, e.msg)
+
+        try:
+            board = KanbanBoard(board_id, self.ticket_fields, self.env, self.log)
+        except InvalidDataError as e:
+            return self._send_error(req, e.msg)
+        except InvalidFieldError as e:
+            return self._send_error(req, 'Invalid ticket fields: %s' % ', '.join(e.fields))
 
-        board = KanbanBoard(board_id, detailed_tickets, self.ticket_fields, self.env, self.log)
+        if request_data is not None and not is_ticket_call:
+            column_ids = [col['id'] for col in board.columns]
+            unknown_ids = [col['id'] for col in request_data if col['id'] not in column_ids]
+            if unknown_ids:
+                return self._send_error(req, 'Unknown columns: %s' % ', '.join(map(unicode, unknown_ids)))
+
+        board.load_tickets(detailed_tickets)
 
         added = 0
         if len(added_tickets) > 0:
@@ -552,7 +722,7 @@ class KanbanBoardMacro(WikiMacroBase):
             return req.send(board.get_json(True, False), content_type='application/json')
         else:
             if is_ticket_call:
-                ticket_data = json.loads(req.read())
+                ticket_data = request_data
                 is_new = 'id' not in ticket_data
                 id = self.save_ticket(ticket_data, req.authname)
                 if is_new:
@@ -561,14 +731,12 @@ class KanbanBoardMacro(WikiMacroBase):
                     board.update_tickets([id])
             else:
                 modified_tickets = []
-                column_data = json.loads(req.read())
+                column_data = request_data
                 for col in column_data:
-                    for ticket in col['tickets']:
-                        for key, value in ticket.items():
-                            if key != 'id':
-                                self.save_ticket(ticket, req.authname)
-                                modified_tickets.append(ticket['id'])
-                                break
+                    for ticket in col.get('tickets', []):
+                        if len(ticket) > 1:
+                            self.save_ticket(ticket, req.authname)
+                            modified_tickets.append(ticket['id'])
 
                 board.update_columns(column_data)
                 if modified_tickets:
@@ -613,7 +781,7 @@ class KanbanBoardMacro(WikiMacroBase):
             template_data['usage'] = format_to_html(self.env, formatter.context, self.__doc__)
         else:
             try:
-                board = KanbanBoard(page_name, [], self.ticket_fields, self.env, self.log)
+                board = KanbanBoard(page_name, self.ticket_fields, self.env, self.log)
             except InvalidDataError as e:
                 template_data['error'] = e.msg
                 template_data['usage'] = format_to_html(self.env, formatter.context, self.__doc__)
@@ -648,14 +816,98 @@ class KanbanBoardMacro(WikiMacroBase):
             fragment=True).render(strip_whitespace=False)
 
     # In: comma-separated list of integers (as string)
-    # Out: list of integers
+    # Out: list of unique integers in original order
     def _parse_id_list(self, ids):
         result = []
-        parts = ids.split(',')
-        for part in parts:
-            try:
-                result.append(int(part))
-            except ValueError:
-                pass
+        seen = set()
+        for part in ids.split(','):
+            part = part.strip()
+            if not part:
+                continue
+            if not self.ticket_id_regexp.match(part) or int(part) <= 0:
+                raise InvalidRequestError('Invalid ticket ID "%s"' % part)
+            id = int(part)
+            if id not in seen:
+                if len(result) >= self.max_id_list_length:
+                    raise InvalidRequestError('Too many ticket IDs (max %d)' % self.max_id_list_length)
+                seen.add(id)
+                result.append(id)
         return result
 
+    def _read_json(self, req):
+        """Read and parse JSON data from request body. Size of the body is checked before
+           reading it.
+        """
+        try:
+            length = int(req.get_header('Content-Length'))
+        except (TypeError, ValueError):
+            length = -1
+        if length < 0:
+            raise InvalidRequestError('Missing or invalid Content-Length')
+        if length > self.max_request_size:
+            raise InvalidRequestError('Request too large (max %d bytes)' % self.max_request_size)
+
+        try:
+            return json.loads(req.read())
+        except ValueError:
+            raise InvalidRequestError('Invalid JSON data')
+
+    def _validate_ticket_data(self, ticket_data, allow_new=True):
+        if not isinstance(ticket_data, dict):
+            raise InvalidRequestError('Ticket data must be an object')
+
+        if 'id' in ticket_data:
+            if not self._is_ticket_id(ticket_data['id']):
+                raise InvalidRequestError('Invalid ticket ID "%s"' % ticket_data['id'])
+        elif not allow_new:
+            raise InvalidRequestError('Ticket ID is missing')
+
+        valid_names = [f['name'] for f in self.ticket_fields if f['name'] not in self.read_only_fields]
+        invalid_fields = []
+        for key, value in ticket_data.items():
+            if key == 'id':
+                continue
+            if key != 'comment' and key not in valid_names:
+                invalid_fields.append(key)
+            elif not isinstance(value, basestring):
+                raise InvalidRequestError('Invalid value for ticket field "%s"' % key)
+        if invalid_fields:
+            raise InvalidRequestError('Invalid ticket fields: %s' % ', '.join(invalid_fields))
+
+    def _validate_column_data(self, column_data):
+        if not isinstance(column_data, list):
+            raise InvalidRequestError('Column data must be a list')
+
+        valid_states = KanbanBoard.get_valid_states(self.ticket_fields)
+
+        column_ids = []
+        ticket_ids = set()
+        ticket_saves = 0
+        for col in column_data:
+            try:
+                KanbanBoard.validate_column(col, valid_states, False)
+            except InvalidDataError as e:
+                raise InvalidRequestError(e.msg)
+            if col['id'] in column_ids:
+                raise InvalidRequestError('Duplicate column %d' % col['id'])
+            column_ids.append(col['id'])
+
+            for ticket in col.get('tickets', []):
+                if len(ticket_ids) >= self.max_ticket_list_length:
+                    raise InvalidRequestError('Too many tickets (max %d)' % self.max_ticket_list_length)
+                self._validate_ticket_data(ticket, False)
+                if ticket['id'] in ticket_ids:
+                    raise InvalidRequestError('Duplicate ticket %d' % ticket['id'])
+                ticket_ids.add(ticket['id'])
+                if len(ticket) > 1:
+                    ticket_saves += 1
+
+        if ticket_saves > self.max_ticket_saves:
+            raise InvalidRequestError('Too many modified tickets (max %d)' % self.max_ticket_saves)
+
+    def _is_ticket_id(self, value):
+        return isinstance(value, (int, long)) and not isinstance(value, bool) and value > 0
+
+    def _send_error(self, req, msg):
+        self.log.error('Invalid request %s: %s' % (req.path_info, msg))
+        return req.send(json.dumps({ 'error': msg }), content_type='application/json', status=400)